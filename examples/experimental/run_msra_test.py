@@ -13,20 +13,27 @@
 # limitations under the License.
 
 import argparse
+import contextlib
+import distutils.util
+import hashlib
+import inspect
 import os
 import random
+import shutil
 import time
 import math
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import numpy as np
 import paddle
 from paddle.io import DataLoader
+from paddle.static import InputSpec
 
 import paddlenlp as ppnlp
 from paddlenlp.transformers import LinearDecayWithWarmup
 from paddlenlp.metrics import ChunkEvaluator
-from paddlenlp.datasets.experimental import load_dataset
+from paddlenlp.datasets.experimental import load_dataset, MapDataset, MSRA_NER
 from paddlenlp.transformers import BertForTokenClassification, BertTokenizer
 from paddlenlp.data import Stack, Tuple, Pad, Dict
 
@@ -57,6 +64,12 @@ parser.add_argument(
     default=8,
     type=int,
     help="Batch size per GPU/CPU for training.", )
+parser.add_argument(
+    "--eval_batch_size",
+    default=None,
+    type=int,
+    help="Batch size per GPU/CPU for evaluation. If None, 4 times of `batch_size` would be used."
+)
 parser.add_argument(
     "--learning_rate",
     default=5e-5,
@@ -102,58 +115,290 @@ parser.add_argument(
     "--seed", type=int, default=42, help="random seed for initialization")
 parser.add_argument(
     "--n_gpu", type=int, default=1, help="number of gpus to use, 0 for cpu.")
+parser.add_argument(
+    "--use_amp",
+    type=distutils.util.strtobool,
+    default=False,
+    help="Enable mixed precision training.")
+parser.add_argument(
+    "--scale_loss",
+    type=float,
+    default=2**15,
+    help="The value of scale_loss for fp16.")
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=min(8, os.cpu_count() or 1),
+    help="Number of DataLoader subprocesses used to collate batches, 0 for collating in the main process."
+)
+parser.add_argument(
+    "--use_shared_memory",
+    type=distutils.util.strtobool,
+    default=True,
+    help="Whether to use shared memory to speed up putting data into inter-process queue."
+)
+parser.add_argument(
+    "--preprocessing_num_workers",
+    type=int,
+    default=min(8, os.cpu_count() or 1),
+    help="Number of processes used to tokenize the datasets before training.")
+parser.add_argument(
+    "--gradient_accumulation_steps",
+    type=int,
+    default=1,
+    help="Number of updates steps to accumulate before performing a backward/update pass."
+)
+parser.add_argument(
+    "--cache_dir",
+    type=str,
+    default=None,
+    help="The directory to cache the tokenized datasets. If set, the cached features would be reused by later runs."
+)
+parser.add_argument(
+    "--to_static",
+    type=distutils.util.strtobool,
+    default=False,
+    help="Whether to train the model converted to static graph by `paddle.jit.to_static`."
+)
 
 
-def evaluate(model, loss_fct, metric, data_loader, label_num):
+@contextlib.contextmanager
+def null_context():
+    # `contextlib.nullcontext` is only available since Python 3.7.
+    yield
+
+
+def set_seed(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    paddle.seed(args.seed)
+
+
+class BucketBatchSampler(paddle.io.DistributedBatchSampler):
+    """
+    A DistributedBatchSampler which batches examples of similar lengths
+    together to reduce padding. The indices of the dataset are shuffled by
+    epoch and split by rank, then sorted by length in buckets of `bucket_size`
+    batches. The order of the batches is shuffled again at last.
+    Args:
+        dataset (Dataset): The dataset to sample from.
+        lengths (list): The lengths of all examples in `dataset`.
+        batch_size (int): The number of examples per mini-batch.
+        bucket_size (int, optional): The number of mini-batches whose examples
+            are sorted together. Default: 100.
+        **kwargs: Other arguments of `DistributedBatchSampler`, such as
+            `shuffle` and `drop_last`.
+    """
+
+    def __init__(self, dataset, lengths, batch_size, bucket_size=100,
+                 **kwargs):
+        super(BucketBatchSampler, self).__init__(dataset, batch_size,
+                                                 **kwargs)
+        self.lengths = lengths
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = list(range(len(self.dataset)))
+        if self.shuffle:
+            np.random.RandomState(self.epoch).shuffle(indices)
+        # Add extra samples to make it evenly divisible by ranks.
+        indices += indices[:(self.total_size - len(indices))]
+        indices = indices[self.local_rank * self.num_samples:(
+            self.local_rank + 1) * self.num_samples]
+
+        batches = []
+        buffer_size = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), buffer_size):
+            bucket = sorted(
+                indices[start:start + buffer_size],
+                key=lambda idx: self.lengths[idx])
+            batches.extend(
+                bucket[idx:idx + self.batch_size]
+                for idx in range(0, len(bucket), self.batch_size))
+        if self.drop_last and batches and len(batches[
+                -1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            np.random.RandomState(self.epoch).shuffle(batches)
+            self.epoch += 1
+        for batch in batches:
+            yield batch
+
+
+@paddle.no_grad()
+def evaluate(model, loss_fct, metric, data_loader, use_amp=False):
     model.eval()
     metric.reset()
     avg_loss, precision, recall, f1_score = 0, 0, 0, 0
     for batch in data_loader:
         input_ids, segment_ids, length, labels = batch
-        logits = model(input_ids, segment_ids)
-        loss = loss_fct(logits.reshape([-1, label_num]), labels.reshape([-1]))
-        avg_loss = paddle.mean(loss)
+        with paddle.amp.auto_cast(
+                use_amp,
+                custom_black_list=["reduce_sum", "softmax_with_cross_entropy"]):
+            logits = model(input_ids, segment_ids)
+            avg_loss = loss_fct(logits, labels)
         preds = logits.argmax(axis=2)
         num_infer_chunks, num_label_chunks, num_correct_chunks = metric.compute(
             None, length, preds, labels)
         metric.update(num_infer_chunks.numpy(),
                       num_label_chunks.numpy(), num_correct_chunks.numpy())
-        precision, recall, f1_score = metric.accumulate()
+    precision, recall, f1_score = metric.accumulate()
     print("eval loss: %f, precision: %f, recall: %f, f1: %f" %
           (avg_loss, precision, recall, f1_score))
     model.train()
 
 
-def tokenize_and_align_labels(example, tokenizer, no_entity_id,
+def tokenize_and_align_labels(examples,
+                              tokenizer,
+                              no_entity_id,
                               max_seq_len=512):
-    labels = example['labels']
-    example = example['tokens']
-    tokenized_input = tokenizer(
-        example,
+    # Pretokenized words are mapped to ids by vocabulary lookup directly, no
+    # WordPiece is run on them.
+    tokenized_inputs = tokenizer(
+        [example['tokens'] for example in examples],
         return_length=True,
         is_split_into_words=True,
         max_seq_len=max_seq_len)
 
-    if len(tokenized_input['input_ids']) - 2 < len(labels):
-        labels = labels[:len(tokenized_input['input_ids']) - 2]
-    tokenized_input['labels'] = [no_entity_id] + labels + [no_entity_id]
-    tokenized_input['labels'] += [no_entity_id] * (
-        len(tokenized_input['input_ids']) - len(tokenized_input['labels']))
-
-    return tokenized_input
+    for example, tokenized_input in zip(examples, tokenized_inputs):
+        input_ids = tokenized_input['input_ids']
+        labels = example['labels'][:len(input_ids) - 2]
+        # Labels of [CLS], [SEP] and paddings are `no_entity_id`.
+        tokenized_input['labels'] = np.full(
+            len(input_ids), no_entity_id, dtype='int64')
+        tokenized_input['labels'][1:len(labels) + 1] = labels
+        tokenized_input['input_ids'] = np.asarray(input_ids, dtype='int64')
+        tokenized_input['segment_ids'] = np.asarray(
+            tokenized_input['segment_ids'], dtype='int64')
+
+    return tokenized_inputs
+
+
+class MemmapFeatures(paddle.io.Dataset):
+    """
+    Reads the tokenized features saved by `save_features` from memory-mapped
+    numpy files.
+    Args:
+        path (str): The directory the features are saved in.
+    """
+
+    FIELDS = ('input_ids', 'segment_ids', 'labels')
+
+    def __init__(self, path):
+        self.seq_len = np.load(os.path.join(path, 'seq_len.npy'))
+        self.fields = {
+            name: np.load(
+                os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in self.FIELDS
+        }
+
+    def __getitem__(self, idx):
+        seq_len = int(self.seq_len[idx])
+        example = {
+            name: field[idx, :seq_len].astype('int64')
+            for name, field in self.fields.items()
+        }
+        example['seq_len'] = seq_len
+        return example
+
+    def __len__(self):
+        return len(self.seq_len)
+
+
+def save_features(dataset, path, max_seq_len):
+    """
+    Saves the tokenized features of `dataset` into `path` as int32 arrays
+    shaped `[num_examples, max_seq_len]`, which can be read by `MemmapFeatures`.
+    Nothing would be done if `path` already exists.
+    """
+    if os.path.exists(path):
+        return
+    tmp_path = path + '.tmp'
+    # Remove the leftovers of an interrupted run.
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    seq_len = np.array(
+        [example['seq_len'] for example in dataset], dtype='int32')
+    np.save(os.path.join(tmp_path, 'seq_len.npy'), seq_len)
+    for name in MemmapFeatures.FIELDS:
+        field = np.lib.format.open_memmap(
+            os.path.join(tmp_path, name + '.npy'),
+            mode='w+',
+            dtype='int32',
+            shape=(len(dataset), max_seq_len))
+        for idx, example in enumerate(dataset):
+            field[idx, :seq_len[idx]] = example[name]
+        field.flush()
+        del field
+    # Rename at last so that an incomplete cache would never be loaded.
+    os.rename(tmp_path, path)
+
+
+def get_cache_name(args):
+    """
+    Returns the name of the features cache. The absolute path is hashed into
+    the name for local models, so that different local models sharing the
+    same directory name do not share the cache.
+    """
+    model_name = os.path.basename(os.path.normpath(args.model_name_or_path))
+    if os.path.exists(args.model_name_or_path):
+        path_hash = hashlib.md5(
+            os.path.abspath(args.model_name_or_path).encode(
+                'utf-8')).hexdigest()[:8]
+        model_name = "%s_%s" % (model_name, path_hash)
+    return "msra_ner_%s_%d" % (model_name, args.max_seq_length)
+
+
+def get_datasets(splits, trans_func, label_list, args):
+    datasets = [None] * len(splits)
+    cache_paths = None
+    if args.cache_dir:
+        cache_name = get_cache_name(args)
+        cache_paths = [
+            os.path.join(args.cache_dir, "%s_%s" % (cache_name, split))
+            for split in splits
+        ]
+        for idx, path in enumerate(cache_paths):
+            if os.path.exists(path):
+                datasets[idx] = MapDataset(
+                    MemmapFeatures(path), label_list=label_list)
+
+    # Only read and tokenize the splits which are not cached.
+    missing = [idx for idx, dataset in enumerate(datasets) if dataset is None]
+    if missing:
+        raw_datasets = load_dataset(
+            'msra_ner', splits=[splits[idx] for idx in missing], lazy=False)
+        if len(missing) == 1:
+            raw_datasets = [raw_datasets]
+        for idx, dataset in zip(missing, raw_datasets):
+            # Tokenize all examples once before training rather than on demand.
+            datasets[idx] = dataset.map(
+                trans_func,
+                lazy=False,
+                batch_size=1000,
+                num_workers=args.preprocessing_num_workers)
+            if cache_paths and paddle.distributed.get_rank() == 0:
+                save_features(datasets[idx], cache_paths[idx],
+                              args.max_seq_length)
+    return datasets
 
 
 def do_train(args):
+    if args.to_static and args.use_amp:
+        raise ValueError(
+            "`to_static` can not be used together with `use_amp`, since "
+            "`auto_cast` is not supported by dynamic-to-static conversion "
+            "in some Paddle 2.0 releases.")
     paddle.set_device("gpu" if args.n_gpu else "cpu")
     if paddle.distributed.get_world_size() > 1:
         paddle.distributed.init_parallel_env()
 
-    train_dataset, test_dataset = load_dataset(
-        'msra_ner', splits=('train', 'test'), lazy=True)
+    set_seed(args)
 
     tokenizer = BertTokenizer.from_pretrained(args.model_name_or_path)
 
-    label_list = train_dataset.label_list
+    label_list = MSRA_NER().get_labels()
     label_num = len(label_list)
     no_entity_id = label_num - 1
 
@@ -163,94 +408,202 @@ def do_train(args):
         no_entity_id=no_entity_id,
         max_seq_len=args.max_seq_length)
 
-    train_dataset = train_dataset.map(trans_func)
-
-    train_dataset = train_dataset.shard()
+    train_dataset, test_dataset = get_datasets(('train', 'test'), trans_func,
+                                               label_list, args)
 
     ignore_label = -100
 
-    batchify_fn = lambda samples, fn=Dict({
-        'input_ids': Pad(axis=0, pad_val=tokenizer.vocab[tokenizer.pad_token]),  # input
-        'segment_ids': Pad(axis=0, pad_val=tokenizer.vocab[tokenizer.pad_token]),  # segment
+    pad_id = tokenizer.vocab[tokenizer.pad_token]
+    # Lengths are only needed by the metric in evaluation.
+    train_batchify_fn = Dict({
+        'input_ids': Pad(axis=0, pad_val=pad_id),  # input
+        'segment_ids': Pad(axis=0, pad_val=pad_id),  # segment
+        # softmax_with_cross_entropy only takes int64 labels at present.
+        'labels': Pad(axis=0, pad_val=ignore_label, dtype='int64')  # label
+    })
+    eval_batchify_fn = Dict({
+        'input_ids': Pad(axis=0, pad_val=pad_id),  # input
+        'segment_ids': Pad(axis=0, pad_val=pad_id),  # segment
         'seq_len': Stack(),
-        'labels': Pad(axis=0, pad_val=ignore_label)  # label
-    }): fn(samples)
+        'labels': Pad(axis=0, pad_val=ignore_label, dtype='int64')  # label
+    })
+
+    # Read lengths of the cached features directly rather than loading every
+    # example from the memory-mapped files.
+    if isinstance(train_dataset.data, MemmapFeatures):
+        train_lengths = train_dataset.data.seq_len.tolist()
+    else:
+        train_lengths = [example['seq_len'] for example in train_dataset]
+    train_batch_sampler = BucketBatchSampler(
+        train_dataset,
+        lengths=train_lengths,
+        batch_size=args.batch_size,
+        shuffle=True,
+        drop_last=True)
 
+    # `use_buffer_reader` prefetches the next batches into a buffer in a
+    # background thread, which already overlaps data loading with training.
     train_data_loader = DataLoader(
         dataset=train_dataset,
-        collate_fn=batchify_fn,
-        num_workers=0,
-        batch_size=args.batch_size,
+        batch_sampler=train_batch_sampler,
+        collate_fn=train_batchify_fn,
+        num_workers=args.num_workers,
+        use_buffer_reader=True,
+        use_shared_memory=args.use_shared_memory,
         return_list=True)
 
-    test_dataset = test_dataset.map(trans_func)
-
     test_data_loader = DataLoader(
         dataset=test_dataset,
-        collate_fn=batchify_fn,
-        num_workers=0,
-        batch_size=args.batch_size,
+        collate_fn=eval_batchify_fn,
+        num_workers=args.num_workers,
+        batch_size=args.eval_batch_size or args.batch_size * 4,
+        use_buffer_reader=True,
+        use_shared_memory=args.use_shared_memory,
         return_list=True)
 
     model = BertForTokenClassification.from_pretrained(
         args.model_name_or_path, num_classes=label_num)
+    if args.to_static:
+        model = paddle.jit.to_static(
+            model,
+            input_spec=[
+                InputSpec(
+                    shape=[None, None], dtype="int64", name="input_ids"),
+                InputSpec(
+                    shape=[None, None], dtype="int64", name="segment_ids")
+            ])
     if paddle.distributed.get_world_size() > 1:
         model = paddle.DataParallel(model)
 
-    num_training_steps = 2812
+    # Each epoch ends with an update even if its last accumulation window is
+    # not full.
+    num_steps_per_epoch = len(train_data_loader)
+    num_training_steps = int(
+        math.ceil(num_steps_per_epoch * 1.0 /
+                  args.gradient_accumulation_steps)) * args.num_train_epochs
 
     lr_scheduler = LinearDecayWithWarmup(args.learning_rate, num_training_steps,
                                          args.warmup_steps)
 
+    # Generate parameter names needed to perform weight decay once, so that
+    # `apply_decay_param_fun` is a set lookup.
+    decay_params = {
+        p.name
+        for n, p in model.named_parameters()
+        if not any(nd in n for nd in ["bias", "norm"])
+    }
     optimizer = paddle.optimizer.AdamW(
         learning_rate=lr_scheduler,
         epsilon=args.adam_epsilon,
         parameters=model.parameters(),
         weight_decay=args.weight_decay,
-        apply_decay_param_fun=lambda x: x in [
-            p.name for n, p in model.named_parameters()
-            if not any(nd in n for nd in ["bias", "norm"])
-        ])
-
+        apply_decay_param_fun=lambda x: x in decay_params,
+        grad_clip=paddle.nn.ClipGradByGlobalNorm(args.max_grad_norm))
+    # Release gradients instead of setting them to zero if supported, which is
+    # not available in Paddle 2.0.x.
+    clear_grad_kwargs = {
+        "set_to_zero": False
+    } if "set_to_zero" in inspect.signature(
+        optimizer.clear_grad).parameters else {}
+
+    # The loss is computed over the last axis of logits shaped
+    # `[batch_size, seq_len, num_classes]` directly, no reshape is needed.
     loss_fct = paddle.nn.loss.CrossEntropyLoss(ignore_index=ignore_label)
 
     metric = ChunkEvaluator(label_list=label_list)
 
+    if args.use_amp:
+        scaler = paddle.amp.GradScaler(init_loss_scaling=args.scale_loss)
+
+    # Copy parameters to host memory synchronously and write them to disk in
+    # a background thread, so that training is not blocked by the file I/O.
+    # Only one save is in flight at a time, and errors of the last save are
+    # raised by `future.result()`.
+    save_pool = ThreadPoolExecutor(1)
+    save_future = None
+
+    def save_model(model, global_step):
+        nonlocal save_future
+        if save_future is not None:
+            save_future.result()
+        state_dict = {
+            name: value.numpy()
+            for name, value in model.state_dict().items()
+        }
+        save_future = save_pool.submit(
+            paddle.save, state_dict,
+            os.path.join(args.output_dir, "model_%d.pdparams" % global_step))
+
     global_step = 0
     tic_train = time.time()
     for epoch in range(args.num_train_epochs):
+        train_batch_sampler.set_epoch(epoch)
         for step, batch in enumerate(train_data_loader):
+            input_ids, segment_ids, labels = batch
+            # Keep the loss computation in fp32 to avoid underflow.
+            with paddle.amp.auto_cast(
+                    args.use_amp,
+                    custom_black_list=[
+                        "reduce_sum", "softmax_with_cross_entropy"
+                    ]):
+                logits = model(input_ids, segment_ids)
+                loss = loss_fct(logits, labels)
+            # The last accumulation window of an epoch may be shorter.
+            window_start = step - step % args.gradient_accumulation_steps
+            window_size = min(args.gradient_accumulation_steps,
+                              num_steps_per_epoch - window_start)
+            if window_size > 1:
+                loss = loss / window_size
+            # Skip the gradient all-reduce of DataParallel on the micro
+            # steps, gradients are only synchronized on the last one.
+            # `no_sync` is not available in Paddle 2.0.x, gradients are
+            # all-reduced on every micro step there.
+            # Also update on the last batch of each epoch, so that leftover
+            # gradients are neither carried into the next epoch nor dropped.
+            is_update_step = (
+                step + 1) % args.gradient_accumulation_steps == 0 or (
+                    step + 1) == num_steps_per_epoch
+            if not is_update_step and hasattr(model, "no_sync"):
+                sync_context = model.no_sync()
+            else:
+                sync_context = null_context()
+            with sync_context:
+                if args.use_amp:
+                    scaled_loss = scaler.scale(loss)
+                    scaled_loss.backward()
+                else:
+                    loss.backward()
+            if not is_update_step:
+                continue
+
             global_step += 1
-            input_ids, segment_ids, _, labels = batch
-            logits = model(input_ids, segment_ids)
-            loss = loss_fct(
-                logits.reshape([-1, label_num]), labels.reshape([-1]))
-            avg_loss = paddle.mean(loss)
+            if args.use_amp:
+                scaler.minimize(optimizer, scaled_loss)
+            else:
+                optimizer.step()
+            lr_scheduler.step()
+            optimizer.clear_grad(**clear_grad_kwargs)
             if global_step % args.logging_steps == 0:
                 print(
                     "global step %d, epoch: %d, batch: %d, loss: %f, speed: %.2f step/s"
-                    % (global_step, epoch, step, avg_loss,
+                    % (global_step, epoch, step,
+                       loss * window_size,
                        args.logging_steps / (time.time() - tic_train)))
                 tic_train = time.time()
-            avg_loss.backward()
-            optimizer.step()
-            lr_scheduler.step()
-            optimizer.clear_gradients()
             if global_step % args.save_steps == 0:
                 if (not args.n_gpu > 1) or paddle.distributed.get_rank() == 0:
                     evaluate(model, loss_fct, metric, test_data_loader,
-                             label_num)
-                    paddle.save(model.state_dict(),
-                                os.path.join(args.output_dir,
-                                             "model_%d.pdparams" % global_step))
+                             args.use_amp)
+                    save_model(model, global_step)
 
     # Save final model 
     if (global_step) % args.save_steps != 0:
         if (not args.n_gpu > 1) or paddle.distributed.get_rank() == 0:
-            evaluate(model, loss_fct, metric, test_data_loader, label_num)
-            paddle.save(model.state_dict(),
-                        os.path.join(args.output_dir,
-                                     "model_%d.pdparams" % global_step))
+            evaluate(model, loss_fct, metric, test_data_loader, args.use_amp)
+            save_model(model, global_step)
+    save_pool.shutdown(wait=True)
+    if save_future is not None:
+        save_future.result()
 
 
 if __name__ == "__main__":
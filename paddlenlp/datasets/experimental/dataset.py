@@ -28,6 +28,7 @@ from paddlenlp.utils.env import DATA_HOME
 from typing import Iterable, Iterator, Optional, List, Any, Callable, Union
 import importlib
 from functools import partial
+from multiprocessing import Pool
 
 __all__ = ['MapDataset', 'DatasetBuilder', 'IterDataset', 'load_dataset']
 
@@ -207,21 +208,50 @@ class MapDataset(Dataset):
 
         return self
 
-    def map(self, fn, lazy=True):
+    def map(self, fn, lazy=True, batch_size=None, num_workers=0):
         """
         Performs specific function on the dataset to transform and update every sample.
         Args:
             fn (callable): Transformations to be performed. It receives single
-                sample as argument if lazy is True. Else it receives all examples.
+                sample as argument if lazy is True. Else it receives a list of
+                examples and returns a list of transformed examples.
             lazy (bool, optional): If True, transformations would be delayed and
                 performed on demand. Otherwise, transforms all samples at once. Note that if `fn` is
                 stochastic, `lazy` should be True or you will get the same
                 result on all epochs. Defalt: False.
+            batch_size (int, optional): Only works when `lazy` is False. If set,
+                `fn` receives `batch_size` examples at a time and the results
+                are concatenated. If None, `fn` receives all examples.
+                Default: None.
+            num_workers (int, optional): Only works when `lazy` is False. The
+                number of processes used to perform `fn` on batches of
+                examples. 0 means transforming in the main process. Note that
+                `fn` would be sent to the worker processes by pickle if
+                `num_workers` > 0, so it must be picklable, such as a module
+                level function or a `functools.partial` of it, rather than a
+                lambda or a nested function. Default: 0.
         """
         if lazy:
             self._transform_pipline.append(fn)
-        else:
+        elif batch_size is None and num_workers == 0:
             self.new_data = fn(self.new_data)
+        else:
+            if batch_size is None:
+                batch_size = max(
+                    int(math.ceil(len(self.new_data) * 1.0 / num_workers)), 1)
+            batches = [[
+                self.new_data[idx]
+                for idx in range(start,
+                                 min(start + batch_size, len(self.new_data)))
+            ] for start in range(0, len(self.new_data), batch_size)]
+            if num_workers > 0:
+                with Pool(num_workers) as pool:
+                    results = pool.map(fn, batches)
+            else:
+                results = [fn(batch) for batch in batches]
+            self.new_data = [
+                example for result in results for example in result
+            ]
         return self
 
     def __getattr__(self, name):
@@ -0,0 +1,46 @@
+# Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from paddlenlp.datasets.experimental import MapDataset
+
+
+def double_all(examples):
+    return [{'x': example['x'] * 2} for example in examples]
+
+
+class TestMapDatasetMap(unittest.TestCase):
+    def setUp(self):
+        self.examples = [{'x': i} for i in range(10)]
+        self.expected = MapDataset(list(self.examples)).map(
+            double_all, lazy=False).new_data
+
+    def check(self, **kwargs):
+        dataset = MapDataset(list(self.examples)).map(
+            double_all, lazy=False, **kwargs)
+        self.assertEqual(dataset.new_data, self.expected)
+
+    def test_batched(self):
+        self.check(batch_size=3)
+
+    def test_batched_with_workers(self):
+        self.check(batch_size=3, num_workers=2)
+
+    def test_workers_without_batch_size(self):
+        self.check(num_workers=3)
+
+
+if __name__ == '__main__':
+    unittest.main()